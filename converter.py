@@ -3,199 +3,384 @@ Script to convert JUnit/Google Test report to Sonar Generic Test Report
 """
 
 import argparse
+from itertools import izip
 from lxml import etree
-import enum
+import mmap
+import multiprocessing
 import os, os.path
 import re
 import StringIO
 import sys
+from xml.sax.saxutils import escape
 
-GTEST_RE = re.compile(r'TEST.*\((.+),(.+)\)')
+GTEST_RE = re.compile(r'TEST[A-Z_]*\(\s*([A-Za-z_]\w*)\s*,\s*([A-Za-z_]\w*)\s*\)')
 
+# Reports need neither blank text nor ID tables. huge_tree stays off: it also disables libxml2's guard
+# against entity expansion bombs, which entities resolved for the parser target would otherwise get past.
+REPORT_PARSER_OPTIONS = dict(remove_blank_text=True, collect_ids=False)
 
-class TestMsgType(enum.Enum):
+
+# Tags of the message elements a test case may carry; the Sonar report uses the same names.
+test_msg_tags = frozenset(['skipped', 'failure', 'error'])
+
+
+# A testCase element without a message; shared by both serializer loops.
+TEST_CASE_XML = u'    <testCase name={0} duration="{1}"/>\n'
+
+# Characters that need escaping in a double-quoted attribute value, and their replacements beyond &, < and >.
+ATTR_SPECIAL_RE = re.compile(r'[&<>"\n\r\t]')
+ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+# Keeps a literal CR in message text, which XML readers would otherwise normalise to LF.
+TEXT_ENTITIES = {'\r': '&#13;'}
+
+
+# Directories that never hold reports or test sources; see also --exclude_dir.
+SKIP_DIRS = frozenset(['.git', '.svn', '.hg', '__pycache__', 'node_modules', 'CMakeFiles'])
+
+
+def _iter_matching(root, regexp_search, skip_dirs=SKIP_DIRS):
     """
-    The type of test message.
+    Yield the path of every file under root whose name matches regexp_search, not descending into skip_dirs.
     """
-    failure = 1
-    error = 2
-    skipped = 3
+    join = os.path.join
+    for dirName, subdirList, fileList in os.walk(root, followlinks=False):
+        subdirList[:] = [d for d in subdirList if d not in skip_dirs]
+
+        for fileName in fileList:
+            if regexp_search(fileName) is not None:
+                yield join(dirName, fileName)
 
 
-test_msg_type_map = {
-    TestMsgType.skipped: 'skipped',
-    TestMsgType.failure: 'failure',
-    TestMsgType.error: 'error'
-}
+_duration_cache = {}
+
+
+def _ms_from_secs_str(secs):
+    """
+    Convert a report time in seconds to a Sonar duration in milliseconds, memoizing the most common values.
+    """
+    ms = _duration_cache.get(secs)
+    if ms is None:
+        ms = str(int(float(secs) * 1000))
+        if len(_duration_cache) < 4096:
+            _duration_cache[secs] = ms
+    return ms
+
+
+def _quote_attr(value):
+    """
+    Return value as a double-quoted XML attribute value; a cheaper xml.sax.saxutils.quoteattr.
+    """
+    if ATTR_SPECIAL_RE.search(value) is None:
+        return '"%s"' % value
+    return '"%s"' % escape(value, ATTR_ENTITIES)
+
 
-test_msg_tag_map = {
-    'skipped': TestMsgType.skipped,
-    'failure': TestMsgType.failure,
-    'error': TestMsgType.error
+def _execution_sink(executions):
+    """
+    Return a lookup giving the SonarTestExcution of a file path, adding it to executions on first use.
+    """
+    def get(file_path):
+        execution = executions.get(file_path)
+        if execution is None:
+            execution = executions[file_path] = SonarTestExcution(file_path)
+        return execution
 
-}
+    return get
 
 
-class TestMsg:
+class TestMsg(object):
     """
     Test case message
     """
 
+    __slots__ = ('_msg_type', '_short_msg', '_long_msg')
+
     def __init__(self, msg_type, short_msg, long_msg):
-        self.msg_type = msg_type
-        self.short_msg = short_msg if short_msg is not None else ''
-        self.long_msg = long_msg if long_msg is not None else ''
+        self._msg_type = msg_type
+        self._short_msg = short_msg if short_msg is not None else ''
+        self._long_msg = long_msg if long_msg is not None else ''
 
     @property
     def msg_type(self):
-        return self.msg_type
+        return self._msg_type
 
     @property
     def short_msg(self):
-        return self.msg_type
+        return self._short_msg
 
     @property
     def long_msg(self):
-        return self.long_msg
+        return self._long_msg
 
 
-class TestCase:
+class SonarTestExcution(object):
     """
-    Test case.
+    Test cases of one source file, stored column-wise: the i-th test case is
+    (names[i], durations[i], msgs[i]).
     """
 
-    def __init__(self, name, duration, msg=None):
-        self.name = name
-        self.duration = duration
-        self.msg = msg
+    __slots__ = ('_file_path', '_names', '_durations', '_msgs', '_has_msgs')
 
-    @property
-    def name(self):
-        return self.name
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._names = []
+        self._durations = []
+        self._msgs = []
+        self._has_msgs = False
+
+    def add_test_case(self, name, duration, msg=None):
+        self._names.append(name)
+        self._durations.append(duration)
+        self._msgs.append(msg)
+        if msg is not None:
+            self._has_msgs = True
+
+    def extend(self, other):
+        self._names += other.names
+        self._durations += other.durations
+        self._msgs += other.msgs
+        self._has_msgs = self._has_msgs or other.has_msgs
 
     @property
-    def duration(self):
-        return self.duration
+    def names(self):
+        return self._names
 
     @property
-    def msg(self):
-        return self.msg
-
-
-class SonarTestExcution:
-
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.test_cases = []
-
-    def add_test_case(self, test_case):
-        self.test_cases.append(test_case)
+    def durations(self):
+        return self._durations
 
-    def add_test_cases(self, test_cases):
-        self.test_cases += test_cases
+    @property
+    def msgs(self):
+        return self._msgs
 
     @property
-    def test_cases(self):
-        return self.test_cases
+    def has_msgs(self):
+        return self._has_msgs
 
     @property
     def file_path(self):
-        return self.file_path
+        return self._file_path
 
 
 class SonarTestExcutionsXmlSerializer:
 
     @staticmethod
-    def serialize(test_executions):
-        root = etree.Element('testExecutions', version='1')
+    def serialize(test_executions, output_path):
+        with open(output_path, 'wb') as fp:
+            SonarTestExcutionsXmlSerializer.serialize_to_stream(test_executions, fp)
+
+    @staticmethod
+    def serialize_to_stream(test_executions, fp):
+        write = fp.write
+        format_test_case = TEST_CASE_XML.format
+        quote_attr = _quote_attr
+
+        write('<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<testExecutions version="1">\n')
 
         for execution in test_executions:
-            file_tag = etree.SubElement(root, 'file', path=execution.file_path)
+            write(u'  <file path={0}>\n'.format(_quote_attr(execution.file_path)).encode('utf-8'))
+
+            names, durations, msgs = execution.names, execution.durations, execution.msgs
+
+            if not execution.has_msgs:
+                # Common all-green case: no per-case message check needed.
+                for name, duration in izip(names, durations):
+                    write(format_test_case(quote_attr(name), duration).encode('utf-8'))
+
+                write('  </file>\n')
+                continue
+
+            for i in xrange(len(names)):
+                msg = msgs[i]
+
+                if msg is None:
+                    write(format_test_case(quote_attr(names[i]), durations[i]).encode('utf-8'))
+                else:
+                    write(u'    <testCase name={0} duration="{1}">\n'
+                          u'      <{2} message={3}>{4}</{2}>\n'
+                          u'    </testCase>\n'.format(
+                              quote_attr(names[i]), durations[i], msg.msg_type,
+                              quote_attr(msg.short_msg), escape(msg.long_msg, TEXT_ENTITIES)).encode('utf-8'))
 
-            for test_case in execution.test_cases:
-                test_case_tag = etree.SubElement(file_tag, 'testCase', name=test_case.name, duration=test_case.duration)
+            write('  </file>\n')
 
-                if test_case.msg is not None:
-                    tag_name = test_msg_type_map[test_case.msg.msg_type]
+        write('</testExecutions>\n')
 
-                    msg_tag = etree.SubElement(test_case_tag, tag_name, message=test_case.msg.short_msg)
-                    msg_tag.text = test_case.msg.long_msg
 
-        return etree.tostring(root, pretty_print=True)
+class TestCaseTarget(object):
+    """
+    lxml parser target streaming each testcase of a report to on_test_case(suite_name, attrib, msg) without
+    building a tree.
+
+    Only testcase elements whose ancestors are exactly suite_path, from the root down, are reported, e.g.
+    ('testsuite',) for /testsuite/testcase. msg is a TestMsg when the testcase has a single message child,
+    else None.
+    """
+
+    def __init__(self, on_test_case, suite_path):
+        self._on_test_case = on_test_case
+        self._suite_path = list(suite_path)
+        self._stack = []
+        self._suite_names = []
+        self._case = None
+        self._case_suite_name = None
+        self._case_depth = 0
+        self._children = 0
+        self._msg = None
+        self._text = None
+        self._chars = None
+
+    def start(self, tag, attrib):
+        stack = self._stack
+        depth = len(stack)
+
+        if tag == 'testsuite':
+            self._suite_names.append(attrib.get('name'))
+
+        if self._case is not None:
+            self._sub_node(tag, attrib)
+        elif tag == 'testcase' and stack == self._suite_path:
+            self._case = attrib
+            self._case_suite_name = self._suite_names[-1]
+            self._case_depth = depth
+            self._children = 0
+            self._msg = None
+
+        stack.append(tag)
+
+    def comment(self, text):
+        # Comments and PIs are children of an Element too, so they count like sub-elements.
+        if self._case is not None:
+            self._sub_node(None, None)
+
+    def pi(self, target, data=None):
+        if self._case is not None:
+            self._sub_node(None, None)
+
+    def _sub_node(self, tag, attrib):
+        if len(self._stack) == self._case_depth + 1:
+            self._children += 1
+            if self._children == 1 and tag in test_msg_tags:
+                self._msg = (tag, attrib.get('message'))
+                self._text = self._chars = []
+            else:
+                self._msg = None
+        else:
+            # Like Element.text, the message text ends at its first sub-node.
+            self._chars = None
+
+    def data(self, data):
+        if self._chars is not None:
+            self._chars.append(data)
+
+    def end(self, tag):
+        self._stack.pop()
+
+        if tag == 'testsuite':
+            self._suite_names.pop()
+
+        if self._case is None:
+            return
+
+        depth = len(self._stack)
+        if depth == self._case_depth + 1:
+            self._chars = None
+        elif depth == self._case_depth:
+            msg = None
+            if self._children == 1 and self._msg is not None:
+                msg = TestMsg(self._msg[0], self._msg[1], ''.join(self._text))
+
+            self._on_test_case(self._case_suite_name, self._case, msg)
+            self._case = None
+
+    def close(self):
+        return None
 
 
 class GoogleTestReportParser:
 
     @staticmethod
-    def parse(searching_folder_path, searching_report_file_pattern, gtest_src_path, gtest_file_pattern):
-        test_name_to_source_name = GoogleTestReportParser.doParseSrcFolder(gtest_src_path, gtest_file_pattern)
+    def parse(searching_folder_path, searching_report_file_pattern, gtest_src_path, gtest_file_pattern,
+              exclude_dirs=()):
+        skip_dirs = SKIP_DIRS.union(exclude_dirs)
+
+        test_name_to_source_name = GoogleTestReportParser.doParseSrcFolder(gtest_src_path, gtest_file_pattern,
+                                                                           skip_dirs)
 
         sonarTestExcutions = {}
 
         regexp = re.compile(searching_report_file_pattern)
 
-        for dirName, subdirList, fileList in os.walk(searching_folder_path):
-            for fileName in fileList:
-                if regexp.search(fileName) is not None:
-                    executionDict = GoogleTestReportParser.doParse(os.path.join(dirName, fileName),
-                                                                   test_name_to_source_name)
-
-                    for key, value in executionDict.iteritems():
-                        if key not in sonarTestExcutions:
-                            sonarTestExcutions[key] = SonarTestExcution(key)
-
-                        sonarTestExcutions[key].add_test_cases(value.test_cases)
+        _parse_reports(list(_iter_matching(searching_folder_path, regexp.search, skip_dirs)),
+                       _parse_gtest_report,
+                       _execution_sink(sonarTestExcutions),
+                       _init_gtest_worker, (test_name_to_source_name,))
 
         return sonarTestExcutions.values()
 
     @staticmethod
-    def doParse(gtest_report_path, test_name_to_source_name):
+    def doParse(gtest_report_path, test_name_to_source_name, sink=None):
         sonarTestExecutions = {}
-        try:
-            tree = etree.parse(gtest_report_path)
-            testSuites = tree.xpath('/testsuites/testsuite')
+        if sink is None:
+            sink = _execution_sink(sonarTestExecutions)
 
-            for testSuite in testSuites:
-                test_suite_name = testSuite.get('name')
+        # Cases are only handed to sink once the whole report parsed, so a broken report is skipped entirely.
+        cases = []
+        missing = []
 
-                testCases = testSuite.xpath('testcase')
-                for testCase in testCases:
-                    testName = '{0}.{1}'.format(test_suite_name, testCase.get('name'))
+        def add_test_case(test_suite_name, attrib, msg):
+            testName = '{0}.{1}'.format(test_suite_name, attrib.get('name'))
 
-                    if testName in test_name_to_source_name:
-                        test_file_name = test_name_to_source_name[testName]
-                        if test_file_name not in sonarTestExecutions:
-                            sonarTestExecutions[test_file_name] = SonarTestExcution(test_file_name)
+            if testName in test_name_to_source_name:
+                cases.append((test_name_to_source_name[testName],
+                              testName,
+                              _ms_from_secs_str(attrib.get('time') or '0'),
+                              msg))
+            else:
+                missing.append(testName)
 
-                        sonarTestExecutions[test_file_name].add_test_case(
-                            TestCase(testName,
-                                     str(int(float(testCase.get('time')) * 1000)),
-                                     JUnitTestReportParser.doParseMsg(testCase))
-                        )
-                    else:
-                        print "Couldn't find test case named {} in source code. Skip it.".format(testName)
+        try:
+            target = TestCaseTarget(add_test_case, ('testsuites', 'testsuite'))
+            etree.parse(gtest_report_path, etree.XMLParser(target=target, **REPORT_PARSER_OPTIONS))
 
         except Exception as e:
             print "Can't parse report file of {0}. Skip it. due to {1}".format(gtest_report_path, e)
+            return sonarTestExecutions
+
+        for file_path, name, duration, msg in cases:
+            sink(file_path).add_test_case(name, duration, msg)
+
+        if missing:
+            print "Couldn't find {0} test case(s) of {1} in source code. Skip them: {2}{3}".format(
+                len(missing), gtest_report_path, ', '.join(missing[:10]), ', ...' if len(missing) > 10 else '')
 
         return sonarTestExecutions
 
     @staticmethod
-    def doParseSrcFolder(gtest_src_folder, gtest_file_pattern):
+    def doParseSrcFolder(gtest_src_folder, gtest_file_pattern, skip_dirs=SKIP_DIRS):
         test_name_to_source_name = {}
 
         regexp = re.compile(gtest_file_pattern)
 
-        for dirName, subdirList, fileList in os.walk(gtest_src_folder):
-            for fileName in fileList:
-                if regexp.search(fileName) is not None:
-                    file_path = os.path.join(dirName, fileName)
-                    with open(file_path, 'r') as src_file:
-                        for line in src_file:
-                            match = GTEST_RE.search(line)
-                            if match:
-                                test_name_to_source_name[
-                                    '{0}.{1}'.format(match.group(1).strip(), match.group(2).strip())] = file_path
+        for file_path in _iter_matching(gtest_src_folder, regexp.search, skip_dirs):
+            if isinstance(file_path, str):
+                # intern() only takes byte strings; a unicode root gives unicode paths.
+                file_path = intern(file_path)
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                size = os.fstat(fd).st_size
+                if size == 0:
+                    continue
+
+                src = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+                try:
+                    for match in GTEST_RE.finditer(src):
+                        test_name_to_source_name[intern('{0}.{1}'.format(match.group(1), match.group(2)))] = file_path
+                finally:
+                    src.close()
+            finally:
+                os.close(fd)
 
         return test_name_to_source_name
 
@@ -203,54 +388,89 @@ class GoogleTestReportParser:
 class JUnitTestReportParser:
 
     @staticmethod
-    def parse(searching_folder_path, searching_report_file_pattern):
+    def parse(searching_folder_path, searching_report_file_pattern, exclude_dirs=()):
+        skip_dirs = SKIP_DIRS.union(exclude_dirs)
+
         sonarTestExcutions = {}
 
         regexp = re.compile(searching_report_file_pattern)
 
-        for dirName, subdirList, fileList in os.walk(searching_folder_path):
-            for fileName in fileList:
-                if regexp.search(fileName) is not None:
-                    executionDict = JUnitTestReportParser.doParse(os.path.join(dirName, fileName))
-
-                    for key, value in executionDict.iteritems():
-                        if key not in sonarTestExcutions:
-                            sonarTestExcutions[key] = SonarTestExcution(key)
-
-                        sonarTestExcutions[key].add_test_cases(value.test_cases)
+        _parse_reports(list(_iter_matching(searching_folder_path, regexp.search, skip_dirs)),
+                       _parse_junit_report,
+                       _execution_sink(sonarTestExcutions))
 
         return sonarTestExcutions.values()
 
     @staticmethod
-    def doParse(report_file_path):
+    def doParse(report_file_path, sink=None):
         sonarTestExecutions = {}
-        try:
-            tree = etree.parse(report_file_path)
-            testCases = tree.xpath('/testsuite/testcase')
+        if sink is None:
+            sink = _execution_sink(sonarTestExecutions)
+
+        # Cases are only handed to sink once the whole report parsed, so a broken report is skipped entirely.
+        cases = []
 
-            for testCase in testCases:
-                if testCase.get('file') not in sonarTestExecutions:
-                    sonarTestExecutions[testCase.get('file')] = SonarTestExcution(testCase.get('file'))
+        def add_test_case(test_suite_name, attrib, msg):
+            cases.append((attrib.get('file'),
+                          '{0}.{1}'.format(attrib.get('classname'), attrib.get('name')),
+                          _ms_from_secs_str(attrib.get('time') or '0'),
+                          msg))
 
-                sonarTestExecutions[testCase.get('file')].add_test_case(
-                    TestCase('{0}.{1}'.format(testCase.get('classname'), testCase.get('name')),
-                             str(int(float(testCase.get('time')) * 1000)),
-                             JUnitTestReportParser.doParseMsg(testCase))
-                )
+        try:
+            target = TestCaseTarget(add_test_case, ('testsuite',))
+            etree.parse(report_file_path, etree.XMLParser(target=target, **REPORT_PARSER_OPTIONS))
 
         except Exception as e:
             print "Can't parse report file of {0}. Skip it. due to {1}".format(report_file_path, e)
+            return sonarTestExecutions
+
+        for file_path, name, duration, msg in cases:
+            sink(file_path).add_test_case(name, duration, msg)
 
         return sonarTestExecutions
 
-    @staticmethod
-    def doParseMsg(test_case_node):
-        if len(test_case_node) == 1:
-            if test_case_node[0].tag in test_msg_tag_map:
-                return TestMsg(test_msg_tag_map[test_case_node[0].tag],
-                               test_case_node[0].get('message'),
-                               test_case_node[0].text)
-        return None
+
+_gtest_worker_source_map = None
+
+
+def _init_gtest_worker(test_name_to_source_name):
+    global _gtest_worker_source_map
+    _gtest_worker_source_map = test_name_to_source_name
+
+
+def _parse_gtest_report(gtest_report_path, sink=None):
+    return GoogleTestReportParser.doParse(gtest_report_path, _gtest_worker_source_map, sink)
+
+
+def _parse_junit_report(report_file_path, sink=None):
+    return JUnitTestReportParser.doParse(report_file_path, sink)
+
+
+def _parse_reports(report_paths, parse_report, sink, initializer=None, initargs=()):
+    """
+    Parse report_paths and add the results to sink, using a pool of worker processes when there is more than
+    one report and more than one CPU.
+
+    parse_report and initializer must be module-level functions so they can be pickled.
+    """
+    processes = min(len(report_paths), multiprocessing.cpu_count())
+
+    if processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+
+        for report_path in report_paths:
+            parse_report(report_path, sink)
+        return
+
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        for executionDict in pool.imap(parse_report, report_paths, 8):
+            for key, value in executionDict.iteritems():
+                sink(key).extend(value)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -286,18 +506,23 @@ if __name__ == '__main__':
                         type=str,
                         help='the pattern of the gtest source file name')
 
+    parser.add_argument('--exclude_dir',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='name of a directory not to search, in addition to VCS/cache directories; repeatable')
+
     args = parser.parse_args()
 
     test_cases = []
     if args.report_type == 'junit':
-        test_cases = JUnitTestReportParser.parse(args.search_folder, args.report_pattern)
+        test_cases = JUnitTestReportParser.parse(args.search_folder, args.report_pattern, args.exclude_dir)
     elif args.report_type == 'gtest':
         if args.gtest_src_folder is None or args.gtest_src_pattern is None:
             print('for gtest report, the gtest source folder and gtest src file name pattern are required.')
             sys.exit(1)
 
         test_cases = GoogleTestReportParser.parse(args.search_folder, args.report_pattern, args.gtest_src_folder,
-                                                  args.gtest_src_pattern)
+                                                  args.gtest_src_pattern, args.exclude_dir)
 
-    with open(args.output, 'w') as file:
-        file.write(SonarTestExcutionsXmlSerializer.serialize(test_cases))
+    SonarTestExcutionsXmlSerializer.serialize(test_cases, args.output)